@@ -0,0 +1,90 @@
+"""TorchScript versions of the count likelihoods used in the JVAE hot path
+
+All functions return the elementwise negative log likelihood so that the whole
+closed form can be fused into a single kernel. Reducing over genes is left to the caller.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+@torch.jit.script
+def nb_nll(x, mu, theta, log_theta, eps: float = 1e-8):
+    """
+    Negative log likelihood of a nb model.
+
+    Variables:
+    mu: mean of the negative binomial (has to be positive support) (shape: minibatch x genes)
+    theta: inverse dispersion parameter (has to be positive support) (shape: minibatch x genes or genes)
+    log_theta: log of theta, as output by the model before exponentiation
+    eps: numerical stability constant
+    """
+    log_mu_eps = torch.log(mu + eps)
+    log_theta_mu_eps = torch.logaddexp(log_theta, log_mu_eps)
+    res = (
+        theta * (log_theta - log_theta_mu_eps)
+        + x * (log_mu_eps - log_theta_mu_eps)
+        + torch.lgamma(x + theta)
+        - torch.lgamma(theta)
+        - torch.lgamma(x + 1)
+    )
+    return -res
+
+
+@torch.jit.script
+def zinb_nll(x, mu, theta, log_theta, pi, zero_mask, eps: float = 1e-8):
+    """
+    Negative log likelihood of a zinb model.
+    The bernoulli is parametrized using the logits, hence the softplus functions appearing.
+    Both the zero and non-zero cases are computed and selected with ``torch.where`` on ``zero_mask``.
+
+    Variables:
+    mu: mean of the negative binomial (has to be positive support) (shape: minibatch x genes)
+    theta: inverse dispersion parameter (has to be positive support) (shape: minibatch x genes or genes)
+    log_theta: log of theta, as output by the model before exponentiation
+    pi: logit of the dropout parameter (real support) (shape: minibatch x genes)
+    zero_mask: boolean tensor ``x == 0``, computed once by the caller (shape: minibatch x genes)
+    eps: numerical stability constant
+    """
+    softplus_pi = F.softplus(-pi)
+    log_mu_eps = torch.log(mu + eps)
+    log_theta_mu_eps = torch.logaddexp(log_theta, log_mu_eps)
+    pi_theta_log = -pi + theta * (log_theta - log_theta_mu_eps)
+
+    case_zero = F.softplus(pi_theta_log) - softplus_pi
+    case_non_zero = (
+        -softplus_pi
+        + pi_theta_log
+        + x * (log_mu_eps - log_theta_mu_eps)
+        + torch.lgamma(x + theta)
+        - torch.lgamma(theta)
+        - torch.lgamma(x + 1)
+    )
+    res = torch.where(zero_mask, case_zero, case_non_zero)
+    return -res
+
+
+@torch.jit.script
+def kl_normal_std(mu, var):
+    """
+    KL divergence between N(mu, var) and the standard normal, elementwise.
+    """
+    return 0.5 * (var + mu * mu - 1.0 - torch.log(var))
+
+
+@torch.jit.script
+def kl_normal_normal(mu1, var1, mu2, var2):
+    """
+    KL divergence between N(mu1, var1) and N(mu2, var2), elementwise.
+    Uses the variances directly so no square root is needed.
+    """
+    return 0.5 * (torch.log(var2 / var1) + (var1 + (mu1 - mu2).pow(2)) / var2 - 1.0)
+
+
+@torch.jit.script
+def poisson_nll(x, rate, lgamma_x1):
+    """
+    Negative log likelihood of a poisson model.
+    ``lgamma_x1`` is ``lgamma(x + 1)``, passed in so that it can be computed once per minibatch.
+    """
+    return rate - torch.xlogy(x, rate) + lgamma_x1
@@ -1,22 +1,50 @@
 # -*- coding: utf-8 -*-
 """Main module."""
-from typing import List, Optional, Union, Tuple
+from contextlib import nullcontext
+from typing import Callable, List, Optional, Union, Tuple
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
-from torch.distributions import Normal, Poisson, kl_divergence as kl
 from torch.nn import ModuleList
 
-from scvi.models.log_likelihood import log_zinb_positive, log_nb_positive
-from scvi.models.modules import Encoder
+from scvi.models._fused_losses import (
+    kl_normal_normal,
+    kl_normal_std,
+    nb_nll,
+    poisson_nll,
+    zinb_nll,
+)
+from scvi.models.modules import Encoder, is_gaussian
 from scvi.models.modules import MultiEncoder, MultiDecoder
-from scvi.models.utils import one_hot
 
 torch.backends.cudnn.benchmark = True
 
 
+def _full_precision(t: torch.Tensor) -> torch.Tensor:
+    """Upcast bfloat16/float16 tensors (e.g. from autocast) to float32, leave others as is"""
+    if t.dtype in (torch.bfloat16, torch.float16):
+        return t.float()
+    return t
+
+
+class Dispersion:
+    """Integer ids of the ``dispersion`` strings, to avoid string comparisons in decode"""
+
+    GENE = 0
+    GENE_BATCH = 1
+    GENE_LABEL = 2
+    GENE_CELL = 3
+
+    ids = {
+        "gene": GENE,
+        "gene-batch": GENE_BATCH,
+        "gene-label": GENE_LABEL,
+        "gene-cell": GENE_CELL,
+    }
+
+
 class JVAE(nn.Module):
     """Joint Variational auto-encoder
 
@@ -48,7 +76,9 @@ class JVAE(nn.Module):
         n_labels: int = 0,
         dispersion: str = "gene-batch",
         log_variational: bool = True,
-        model_type: str = "gaussian"
+        model_type: str = "gaussian",
+        compile_enabled: bool = False,
+        autocast_enabled: bool = False,
     ):
         """
 
@@ -75,6 +105,10 @@ class JVAE(nn.Module):
         :param n_labels: total number of labels
         :param dispersion: See ``vae.py``
         :param log_variational: Log(data+1) prior to encoding for numerical stability. Not normalization.
+        :param compile_enabled: bool: wrap ``forward``, ``encode`` and ``decode`` with ``torch.compile``.
+            Only used for CUDA inputs, CPU inputs always run eagerly
+        :param autocast_enabled: bool: run ``forward`` on CUDA inputs under bfloat16 autocast.
+            The likelihoods and KL divergences are still summed in float32
         """
         super().__init__()
 
@@ -84,6 +118,8 @@ class JVAE(nn.Module):
         self.reconstruction_losses = reconstruction_losses
         self.model_library_bools = model_library_bools
         self.model_type = model_type
+        # the latent samples can then be drawn from noise shared with the library
+        self._gaussian_latent = is_gaussian(model_type)
 
         self.n_latent = n_latent
 
@@ -91,6 +127,7 @@ class JVAE(nn.Module):
         self.n_labels = n_labels
 
         self.dispersion = dispersion
+        self._dispersion_id = Dispersion.ids[dispersion]
         self.log_variational = log_variational
 
         self.z_encoder = MultiEncoder(
@@ -129,15 +166,94 @@ class JVAE(nn.Module):
             dropout_rate=dropout_rate_decoder,
         )
 
-        if self.dispersion == "gene":
+        # batch/label dispersions are stored one row per category, so that the
+        # lookup of each cell in decode reads contiguous memory
+        if self._dispersion_id == Dispersion.GENE:
             self.px_r = torch.nn.Parameter(torch.randn(self.total_genes))
-        elif self.dispersion == "gene-batch":
-            self.px_r = torch.nn.Parameter(torch.randn(self.total_genes, n_batch))
-        elif self.dispersion == "gene-label":
-            self.px_r = torch.nn.Parameter(torch.randn(self.total_genes, n_labels))
+        elif self._dispersion_id == Dispersion.GENE_BATCH:
+            self.px_r = torch.nn.Parameter(torch.randn(n_batch, self.total_genes))
+        elif self._dispersion_id == Dispersion.GENE_LABEL:
+            self.px_r = torch.nn.Parameter(torch.randn(n_labels, self.total_genes))
         else:  # gene-cell
             pass
 
+        # Index mappings are gathered with index_select on device resident long buffers,
+        # slices are kept as is to get views. The lookup tables are resolved once here.
+        self._map_is_slice = tuple(isinstance(m, slice) for m in self.indices_mappings)
+        self._map_buffer_names = tuple(
+            None if is_slice else "idx_map_{}".format(i)
+            for i, is_slice in enumerate(self._map_is_slice)
+        )
+        for mapping, name in zip(self.indices_mappings, self._map_buffer_names):
+            if name is not None:
+                mapping = np.asarray(mapping)
+                if mapping.dtype == np.bool_:
+                    # boolean masks are valid numpy indexers, turn them into positions
+                    mapping = np.flatnonzero(mapping)
+                self.register_buffer(
+                    name, torch.as_tensor(mapping, dtype=torch.long), persistent=False
+                )
+
+        self.autocast_enabled = autocast_enabled
+        self.compile_enabled = compile_enabled and hasattr(torch, "compile")
+        # compiled callables are built lazily on the first CUDA call, see _get_compiled
+        self._compiled = {}
+
+    def _use_compiled(self, x: torch.Tensor) -> bool:
+        return self.compile_enabled and x.is_cuda
+
+    def _get_compiled(self, key: str) -> Callable:
+        """Compiled ``encode``, ``decode`` or ``_forward_impl``, built on first use
+
+        The unbound functions are compiled and take the model as first argument, so that
+        no reference to ``self`` is stored on ``self``. ``mode`` is passed as a Python int,
+        which Dynamo specializes on.
+        """
+        if key not in self._compiled:
+            fn = getattr(type(self), key)
+            if key == "_forward_impl":
+                fn = torch.compile(fn, mode="reduce-overhead", dynamic=False)
+            else:
+                fn = torch.compile(fn, dynamic=False)
+            self._compiled[key] = fn
+        return self._compiled[key]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before px_r was stored as (n_cat, total_genes)
+        # hold it as (total_genes, n_cat), transpose those
+        key = prefix + "px_r"
+        if key in state_dict and self._dispersion_id in (
+            Dispersion.GENE_BATCH,
+            Dispersion.GENE_LABEL,
+        ):
+            px_r = state_dict[key]
+            shape = tuple(self.px_r.shape)
+            if tuple(px_r.shape) != shape and tuple(px_r.shape) == shape[::-1]:
+                state_dict[key] = px_r.t()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def __getstate__(self):
+        # copies compile and cache their own graphs
+        state = self.__dict__.copy()
+        state["_compiled"] = {}
+        return state
+
+    def _gather(self, t: torch.Tensor, mode: int) -> torch.Tensor:
+        """Restrict the last dimension of ``t`` to the genes observed in dataset ``mode``"""
+        if self._map_is_slice[mode]:
+            return t[..., self.indices_mappings[mode]]
+        return t.index_select(-1, self._buffers[self._map_buffer_names[mode]])
+
+    def _gather_all(
+        self, mode: int, *tensors: torch.Tensor
+    ) -> Tuple[torch.Tensor, ...]:
+        """Same as ``_gather`` for several tensors, resolving the mapping only once"""
+        if self._map_is_slice[mode]:
+            mapping = self.indices_mappings[mode]
+            return tuple(t[..., mapping] for t in tensors)
+        index = self._buffers[self._map_buffer_names[mode]]
+        return tuple(t.index_select(-1, index) for t in tensors)
+
     def sample_from_posterior_z(
         self, x: torch.Tensor, mode: int = None, deterministic: bool = False
     ) -> torch.Tensor:
@@ -153,7 +269,7 @@ class JVAE(nn.Module):
                 mode = 0
             else:
                 raise Exception("Must provide a mode when having multiple datasets")
-        qz_m, _, z, _, _, _ = self.encode(x, mode)
+        qz_m, _, z, _, _, _, _ = self.encode(x, mode)
         if deterministic:
             z = qz_m
         return z
@@ -169,7 +285,7 @@ class JVAE(nn.Module):
         :param deterministic: bool - whether to sample or not
         :return: tensor of shape ``(batch_size, 1)``
         """
-        _, _, _, ql_m, _, library = self.encode(x, mode)
+        _, _, _, ql_m, _, library, _ = self.encode(x, mode)
         if deterministic and ql_m is not None:
             library = ql_m
         return library
@@ -196,13 +312,18 @@ class JVAE(nn.Module):
         """
         if decode_mode is None:
             decode_mode = mode
-        qz_m, qz_v, z, ql_m, ql_v, library = self.encode(x, mode)
+        if self._use_compiled(x):
+            encode, decode = self._get_compiled("encode"), self._get_compiled("decode")
+        else:
+            encode, decode = type(self).encode, type(self).decode
+        qz_m, qz_v, z, ql_m, ql_v, library, library_exp = encode(self, x, mode)
         if deterministic:
             z = qz_m
             if ql_m is not None:
                 library = ql_m
-        px_scale, px_r, px_rate, px_dropout = self.decode(
-            z, decode_mode, library, batch_index, y
+                library_exp = None
+        px_scale, px_r, log_px_r, px_rate, px_dropout = decode(
+            self, z, decode_mode, library, batch_index, y, library_exp
         )
 
         return px_scale
@@ -233,13 +354,18 @@ class JVAE(nn.Module):
         """
         if decode_mode is None:
             decode_mode = mode
-        qz_m, qz_v, z, ql_m, ql_v, library = self.encode(x, mode)
+        if self._use_compiled(x):
+            encode, decode = self._get_compiled("encode"), self._get_compiled("decode")
+        else:
+            encode, decode = type(self).encode, type(self).decode
+        qz_m, qz_v, z, ql_m, ql_v, library, library_exp = encode(self, x, mode)
         if deterministic:
             z = qz_m
             if ql_m is not None:
                 library = ql_m
-        px_scale, px_r, px_rate, px_dropout = self.decode(
-            z, decode_mode, library, batch_index, y
+                library_exp = None
+        px_scale, px_r, log_px_r, px_rate, px_dropout = decode(
+            self, z, decode_mode, library, batch_index, y, library_exp
         )
 
         return px_rate
@@ -251,14 +377,23 @@ class JVAE(nn.Module):
         px_r: torch.Tensor,
         px_dropout: torch.Tensor,
         mode: int,
+        log_px_r: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         reconstruction_loss = None
+        if log_px_r is None and self.reconstruction_losses[mode] != "poisson":
+            log_px_r = torch.log(px_r)
         if self.reconstruction_losses[mode] == "zinb":
-            reconstruction_loss = -log_zinb_positive(x, px_rate, px_r, px_dropout)
+            zero_mask = x == 0
+            reconstruction_loss = zinb_nll(
+                x, px_rate, px_r, log_px_r, px_dropout, zero_mask
+            )
         elif self.reconstruction_losses[mode] == "nb":
-            reconstruction_loss = -log_nb_positive(x, px_rate, px_r)
+            reconstruction_loss = nb_nll(x, px_rate, px_r, log_px_r)
         elif self.reconstruction_losses[mode] == "poisson":
-            reconstruction_loss = -torch.sum(Poisson(px_rate).log_prob(x), dim=1)
+            reconstruction_loss = poisson_nll(x, px_rate, torch.lgamma(x + 1))
+        if reconstruction_loss is not None:
+            # sum in float32 even if the inputs come from bfloat16 autocast
+            reconstruction_loss = _full_precision(reconstruction_loss).sum(dim=1)
         return reconstruction_loss
 
     def encode(
@@ -270,19 +405,28 @@ class JVAE(nn.Module):
         Optional[torch.Tensor],
         Optional[torch.Tensor],
         torch.Tensor,
+        torch.Tensor,
     ]:
-        x_ = x
-        if self.log_variational:
-            x_ = torch.log(1 + x_)
+        x_ = torch.log1p(x) if self.log_variational else x
 
-        qz_m, qz_v, z = self.z_encoder(x_, mode)
+        # a single draw of standard normal noise for both z and the library
+        z_noise, l_noise = None, None
+        if self._gaussian_latent:
+            noise = torch.randn(
+                x.size(0), self.n_latent + 1, device=x.device, dtype=x.dtype
+            )
+            z_noise, l_noise = noise[:, : self.n_latent], noise[:, self.n_latent :]
+
+        qz_m, qz_v, z = self.z_encoder.forward_head(mode, x_, noise=z_noise)
         ql_m, ql_v, library = None, None, None
         if self.model_library_bools[mode]:
-            ql_m, ql_v, library = self.l_encoders[mode](x_)
+            ql_m, ql_v, library = self.l_encoders[mode](x_, noise=l_noise)
+            library_exp = torch.exp(library)
         else:
-            library = torch.log(torch.sum(x, dim=1)).view(-1, 1)
+            library_exp = torch.sum(x, dim=1, keepdim=True)
+            library = torch.log(library_exp)
 
-        return qz_m, qz_v, z, ql_m, ql_v, library
+        return qz_m, qz_v, z, ql_m, ql_v, library, library_exp
 
     def decode(
         self,
@@ -291,25 +435,38 @@ class JVAE(nn.Module):
         library: torch.Tensor,
         batch_index: Optional[torch.Tensor] = None,
         y: Optional[torch.Tensor] = None,
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
-        px_scale, px_r, px_rate, px_dropout = self.decoder(
-            z, mode, library, self.dispersion, batch_index, y
+        library_exp: Optional[torch.Tensor] = None,
+    ) -> Tuple[
+        torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor
+    ]:
+        px_scale, log_px_r, px_dropout = self.decoder(
+            z, mode, self.dispersion, batch_index, y
         )
 
-        if self.dispersion == "gene-label":
-            px_r = F.linear(one_hot(y, self.n_labels), self.px_r)
-        elif self.dispersion == "gene-batch":
-            px_r = F.linear(one_hot(batch_index, self.n_batch), self.px_r)
-        elif self.dispersion == "gene":
-            px_r = self.px_r.view(1, self.px_r.size(0))
-        px_r = torch.exp(px_r)
-
-        px_scale = px_scale / torch.sum(
-            px_scale[:, self.indices_mappings[mode]], dim=1
-        ).view(-1, 1)
-        px_rate = px_scale * torch.exp(library)
-
-        return px_scale, px_r, px_rate, px_dropout
+        # look up the dispersion of each cell rather than multiplying by a one-hot matrix
+        if self._dispersion_id == Dispersion.GENE_LABEL:
+            log_px_r = F.embedding(y.view(-1).long(), self.px_r)
+        elif self._dispersion_id == Dispersion.GENE_BATCH:
+            log_px_r = F.embedding(batch_index.view(-1).long(), self.px_r)
+        elif self._dispersion_id == Dispersion.GENE:
+            log_px_r = self.px_r  # broadcasts over cells
+        px_r = torch.exp(log_px_r)
+
+        denom = self._gather(px_scale, mode).sum(dim=1, keepdim=True)
+        # the softmax backward needs its output, so only divide in place without autograd
+        if torch.is_grad_enabled():
+            px_scale = px_scale / denom
+        else:
+            px_scale = px_scale.div_(denom)
+        if library_exp is None:
+            library_exp = torch.exp(library)
+        px_rate = px_scale * library_exp
+
+        # the gathers over genes read the last dimension, make sure it is dense.
+        # This is a no-op for the current decoder, but guards against transposed outputs
+        return tuple(
+            t.contiguous() for t in (px_scale, px_r, log_px_r, px_rate, px_dropout)
+        )
 
     def forward(
         self,
@@ -338,35 +495,47 @@ class JVAE(nn.Module):
                 mode = 0
             else:
                 raise Exception("Must provide a mode")
-
-        qz_m, qz_v, z, ql_m, ql_v, library = self.encode(x, mode)
-        px_scale, px_r, px_rate, px_dropout = self.decode(
-            z, mode, library, batch_index, y
-        )
-
-        # mask loss to observed genes
-        mapping_indices = self.indices_mappings[mode]
-        reconstruction_loss = self.reconstruction_loss(
-            x,
-            px_rate[:, mapping_indices],
-            px_r[:, mapping_indices],
-            px_dropout[:, mapping_indices],
-            mode,
-        )
-
-        # KL Divergence
-        mean = torch.zeros_like(qz_m)
-        scale = torch.ones_like(qz_v)
-        kl_divergence_z = kl(Normal(qz_m, torch.sqrt(qz_v)), Normal(mean, scale)).sum(
-            dim=1
-        )
-
-        if self.model_library_bools[mode]:
-            kl_divergence_l = kl(
-                Normal(ql_m, torch.sqrt(ql_v)),
-                Normal(local_l_mean, torch.sqrt(local_l_var)),
-            ).sum(dim=1)
+        if self._use_compiled(x):
+            forward = self._get_compiled("_forward_impl")
         else:
-            kl_divergence_l = torch.zeros_like(kl_divergence_z)
+            forward = type(self)._forward_impl
+        return forward(self, x, local_l_mean, local_l_var, batch_index, y, mode)
 
-        return reconstruction_loss, kl_divergence_l + kl_divergence_z
+    def _forward_impl(
+        self,
+        x: torch.Tensor,
+        local_l_mean: torch.Tensor,
+        local_l_var: torch.Tensor,
+        batch_index: Optional[torch.Tensor],
+        y: Optional[torch.Tensor],
+        mode: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # an autocast(enabled=False) would also disable autocast set up by the caller
+        if self.autocast_enabled and x.is_cuda:
+            precision = torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+        else:
+            precision = nullcontext()
+        with precision:
+            qz_m, qz_v, z, ql_m, ql_v, library, library_exp = self.encode(x, mode)
+            px_scale, px_r, log_px_r, px_rate, px_dropout = self.decode(
+                z, mode, library, batch_index, y, library_exp
+            )
+
+            # mask loss to observed genes
+            px_rate, px_r, log_px_r, px_dropout = self._gather_all(
+                mode, px_rate, px_r, log_px_r, px_dropout
+            )
+            reconstruction_loss = self.reconstruction_loss(
+                x, px_rate, px_r, px_dropout, mode, log_px_r=log_px_r
+            )
+
+            # KL Divergence
+            kl_divergence = _full_precision(kl_normal_std(qz_m, qz_v)).sum(dim=1)
+
+            # an observed library has no KL term, skip adding zeros
+            if self.model_library_bools[mode]:
+                kl_divergence = kl_divergence + _full_precision(
+                    kl_normal_normal(ql_m, ql_v, local_l_mean, local_l_var)
+                ).sum(dim=1)
+
+        return reconstruction_loss, kl_divergence
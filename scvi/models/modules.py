@@ -1,5 +1,5 @@
 import collections
-from typing import Iterable, List
+from typing import Iterable, List, Optional
 
 import torch
 from torch import nn as nn
@@ -9,6 +9,16 @@ from torch.nn import ModuleList
 from scvi.models.utils import one_hot
 
 
+@torch.jit.script
+def reparam(mu, var, noise):
+    """Gaussian reparameterization from standard normal ``noise``, fused into one kernel"""
+    return mu + torch.sqrt(var) * noise
+
+
+def is_gaussian(model_type) -> bool:
+    """Whether ``model_type`` samples are a gaussian reparameterization, see ``reparam``"""
+    return isinstance(model_type, str) and model_type.lower() == "gaussian"
+
 
 def model_type_to_function(model_type):
     if not isinstance(model_type, str):
@@ -16,11 +26,11 @@ def model_type_to_function(model_type):
     model_type = model_type.lower()
     if model_type == "gaussian":
         def func(mu, var):
-            return Normal(mu, var.sqrt()).rsample()
+            return Normal(mu, var.sqrt(), validate_args=False).rsample()
         return func
     elif model_type == "laplace":
         def func(mu, var):
-            return Laplace(mu, var.sqrt).rsample()
+            return Laplace(mu, var.sqrt(), validate_args=False).rsample()
         return func
     else:
         raise NotImplementedError("Not supported: " + model_type)
@@ -169,8 +179,11 @@ class Encoder(nn.Module):
         self.mean_encoder = nn.Linear(n_hidden, n_output)
         self.var_encoder = nn.Linear(n_hidden, n_output)
         self.latent_model = model_type_to_function(model_type)
+        self.gaussian_latent = is_gaussian(model_type)
 
-    def forward(self, x: torch.Tensor, *cat_list: int):
+    def forward(
+        self, x: torch.Tensor, *cat_list: int, noise: Optional[torch.Tensor] = None
+    ):
         r"""The forward computation for a single sample.
 
          #. Encodes the data into latent space using the encoder network
@@ -179,6 +192,8 @@ class Encoder(nn.Module):
 
         :param x: tensor with shape (n_input,)
         :param cat_list: list of category membership(s) for this sample
+        :param noise: optional standard normal noise of shape ``(n_latent,)`` used for the sample,
+            only for a gaussian ``model_type``
         :return: tensors of shape ``(n_latent,)`` for mean and var, and sample
         :rtype: 3-tuple of :py:class:`torch.Tensor`
         """
@@ -187,7 +202,14 @@ class Encoder(nn.Module):
         q = self.encoder(x, *cat_list)
         q_m = self.mean_encoder(q)
         q_v = torch.exp(self.var_encoder(q)) + 1e-4
-        latent = self.latent_model(q_m, q_v)
+        if noise is None:
+            latent = self.latent_model(q_m, q_v)
+        elif self.gaussian_latent:
+            latent = reparam(q_m, q_v, noise)
+        else:
+            raise ValueError(
+                "noise can only be given to an encoder with a gaussian latent"
+            )
         return q_m, q_v, latent
 
 
@@ -410,14 +432,42 @@ class MultiEncoder(nn.Module):
         self.var_encoder = nn.Linear(n_hidden, n_output)
 
         self.latent_model = model_type_to_function(model_type)
+        self.gaussian_latent = is_gaussian(model_type)
 
     def forward(self, x: torch.Tensor, head_id: int, *cat_list: int):
+        return self.forward_head(head_id, x, *cat_list)
+
+    def forward_head(
+        self,
+        head_id: int,
+        x: torch.Tensor,
+        *cat_list: int,
+        noise: Optional[torch.Tensor] = None
+    ):
+        r"""Encodes ``x`` with the individual layers of head ``head_id`` then the shared layers.
+        Can be called directly with a fixed ``head_id`` to skip ``nn.Module.__call__``.
+
+        :param head_id: id of the individual encoder to use
+        :param x: tensor with shape ``(n_input_list[head_id],)``
+        :param cat_list: list of category membership(s) for this sample
+        :param noise: optional standard normal noise of shape ``(n_output,)`` used for the sample,
+            only for a gaussian ``model_type``
+        :return: tensors of shape ``(n_output,)`` for mean and var, and sample
+        :rtype: 3-tuple of :py:class:`torch.Tensor`
+        """
         q = self.encoders[head_id](x, *cat_list)
         q = self.encoder_shared(q, *cat_list)
 
         q_m = self.mean_encoder(q)
         q_v = torch.exp(self.var_encoder(q))
-        latent = self.latent_model(q_m, q_v)
+        if noise is None:
+            latent = self.latent_model(q_m, q_v)
+        elif self.gaussian_latent:
+            latent = reparam(q_m, q_v, noise)
+        else:
+            raise ValueError(
+                "noise can only be given to an encoder with a gaussian latent"
+            )
 
         return q_m, q_v, latent
 
@@ -476,7 +526,6 @@ class MultiDecoder(nn.Module):
         self,
         z: torch.Tensor,
         dataset_id: int,
-        library: torch.Tensor,
         dispersion: str,
         *cat_list: int
     ):
@@ -489,7 +538,7 @@ class MultiDecoder(nn.Module):
 
         px_scale = self.px_scale_decoder(px)
         px_dropout = self.px_dropout_decoder(px)
-        px_rate = torch.exp(library) * px_scale
         px_r = self.px_r_decoder(px) if dispersion == "gene-cell" else None
 
-        return px_scale, px_r, px_rate, px_dropout
+        # the rate depends on the genes observed in the dataset, it is left to the caller
+        return px_scale, px_r, px_dropout
@@ -11,7 +11,7 @@ with open("HISTORY.rst") as history_file:
 
 requirements = [
     "numpy>=1.16.4",
-    "torch>=0.4.1",
+    "torch>=1.10",
     "matplotlib>=2.0",
     "scikit-learn>=0.18, <0.20.0",
     "scipy>=1.1",
@@ -0,0 +1,54 @@
+import numpy as np
+import torch
+from torch.distributions import Normal, Poisson, kl_divergence
+
+from scvi.models._fused_losses import (
+    kl_normal_normal,
+    kl_normal_std,
+    nb_nll,
+    poisson_nll,
+    zinb_nll,
+)
+from scvi.models.log_likelihood import log_nb_positive, log_zinb_positive
+
+
+def _parameters():
+    rs = np.random.RandomState(0)
+    x = torch.tensor(rs.poisson(2, (16, 10)), dtype=torch.float64)
+    mu = torch.tensor(rs.gamma(2, 2, (16, 10)), dtype=torch.float64)
+    theta = torch.tensor(rs.gamma(2, 2, (16, 10)), dtype=torch.float64)
+    pi = torch.tensor(rs.randn(16, 10), dtype=torch.float64)
+    return x, mu, theta, pi
+
+
+def test_nb_nll():
+    x, mu, theta, _ = _parameters()
+    for theta_ in [theta, theta[0]]:  # per cell and shared dispersion
+        nll = nb_nll(x, mu, theta_, torch.log(theta_)).sum(dim=-1)
+        assert torch.allclose(nll, -log_nb_positive(x, mu, theta_), atol=1e-5)
+
+
+def test_zinb_nll():
+    x, mu, theta, pi = _parameters()
+    assert (x == 0).any()
+    for theta_ in [theta, theta[0]]:
+        nll = zinb_nll(x, mu, theta_, torch.log(theta_), pi, x == 0).sum(dim=-1)
+        assert torch.allclose(nll, -log_zinb_positive(x, mu, theta_, pi), atol=1e-5)
+
+
+def test_poisson_nll():
+    x, mu, _, _ = _parameters()
+    nll = poisson_nll(x, mu, torch.lgamma(x + 1))
+    assert torch.allclose(nll, -Poisson(mu).log_prob(x))
+
+
+def test_kl_normal():
+    rs = np.random.RandomState(0)
+    mu1, mu2 = torch.tensor(rs.randn(2, 16, 4))
+    var1, var2 = torch.tensor(rs.gamma(2, 1, (2, 16, 4)))
+    kl_std = kl_divergence(
+        Normal(mu1, var1.sqrt()), Normal(torch.zeros_like(mu1), torch.ones_like(var1))
+    )
+    assert torch.allclose(kl_normal_std(mu1, var1), kl_std)
+    kl = kl_divergence(Normal(mu1, var1.sqrt()), Normal(mu2, var2.sqrt()))
+    assert torch.allclose(kl_normal_normal(mu1, var1, mu2, var2), kl)
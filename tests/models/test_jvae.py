@@ -0,0 +1,165 @@
+import copy
+import gc
+import weakref
+
+import numpy as np
+import pytest
+import torch
+
+from scvi.models import JVAE
+
+
+def _jvae_losses(mapping, n_input, total_genes=8, reconstruction_loss="nb"):
+    torch.manual_seed(0)
+    jvae = JVAE(
+        [n_input],
+        total_genes,
+        [mapping],
+        [reconstruction_loss],
+        [False],
+        n_batch=1,
+        dispersion="gene",
+    )
+    jvae.eval()
+    x = torch.tensor(np.random.RandomState(0).poisson(3, (6, n_input)) + 1.0).float()
+    ones = torch.ones(6, 1)
+    torch.manual_seed(1)
+    return jvae(x, ones, ones, torch.zeros(6, 1, dtype=torch.long))
+
+
+def test_jvae_boolean_mask_mapping():
+    mask = np.array([True, False, True, True, False, False, True, True])
+    reconst_mask, kl_mask = _jvae_losses(mask, int(mask.sum()))
+    reconst_idx, kl_idx = _jvae_losses(np.flatnonzero(mask), int(mask.sum()))
+    assert torch.allclose(reconst_mask, reconst_idx)
+    assert torch.allclose(kl_mask, kl_idx)
+
+    all_genes = np.ones(8, dtype=bool)
+    reconst_mask, _ = _jvae_losses(all_genes, 8)
+    reconst_slice, _ = _jvae_losses(slice(None), 8)
+    assert torch.allclose(reconst_mask, reconst_slice)
+
+
+def test_jvae_keeps_double_precision():
+    torch.manual_seed(0)
+    jvae = JVAE([5], 5, [slice(None)], ["nb"], [True], dispersion="gene").double()
+    x = torch.tensor(np.random.RandomState(0).poisson(3, (4, 5)) + 1.0).double()
+    ones = torch.ones(4, 1, dtype=torch.float64)
+    reconst_loss, kl_divergence = jvae(x, ones, ones)
+    assert reconst_loss.dtype == torch.float64
+    assert kl_divergence.dtype == torch.float64
+
+
+def test_jvae_compiled_callables_not_shared_by_copies():
+    jvae = JVAE([5], 5, [slice(None)], ["nb"], [False], compile_enabled=True)
+    if not jvae.compile_enabled:  # torch without torch.compile
+        return
+    compiled_encode = jvae._get_compiled("encode")
+    assert jvae._get_compiled("encode") is compiled_encode
+    jvae_copy = copy.deepcopy(jvae)
+    assert jvae_copy._compiled == {}
+    assert jvae_copy._get_compiled("encode") is not compiled_encode
+    assert jvae._compiled
+
+
+def test_jvae_loads_legacy_dispersion_layout():
+    for dispersion in ["gene-batch", "gene-label"]:
+        args = ([5], 5, [slice(None)], ["nb"], [False])
+        kwargs = dict(n_batch=3, n_labels=2, dispersion=dispersion)
+        state_dict = JVAE(*args, **kwargs).state_dict()
+        # px_r used to be stored as (total_genes, n_cat)
+        legacy_px_r = state_dict["px_r"].t().contiguous()
+        state_dict["px_r"] = legacy_px_r
+
+        jvae = JVAE(*args, **kwargs)
+        jvae.load_state_dict(state_dict)
+        assert torch.equal(jvae.px_r, legacy_px_r.t())
+
+
+def test_jvae_single_head_index_mapping():
+    mapping = np.array([0, 2, 3, 6])
+    rs = np.random.RandomState(0)
+    x = torch.tensor(rs.poisson(3, (6, 4)) + 1.0).float()
+    ones = torch.ones(6, 1)
+    batch_index = torch.tensor([[0], [1], [2], [0], [1], [2]])
+    labels = torch.tensor([[0], [1], [1], [0], [1], [0]])
+    for dispersion in ["gene", "gene-batch", "gene-label", "gene-cell"]:
+        for reconstruction_loss in ["zinb", "nb", "poisson"]:
+            for model_library in [True, False]:
+                jvae = JVAE(
+                    [4],
+                    8,
+                    [mapping],
+                    [reconstruction_loss],
+                    [model_library],
+                    n_batch=3,
+                    n_labels=2,
+                    dispersion=dispersion,
+                )
+                reconst_loss, kl_divergence = jvae(x, ones, ones, batch_index, labels)
+                assert reconst_loss.shape == kl_divergence.shape == (6,)
+                assert torch.isfinite(reconst_loss).all()
+                assert torch.isfinite(kl_divergence).all()
+                (reconst_loss + kl_divergence).sum().backward()
+
+                with torch.no_grad():
+                    px_rate = jvae.sample_rate(x, 0, batch_index, labels)
+                assert px_rate.shape == (6, 8)
+
+
+def test_jvae_compile_and_autocast_fall_back_on_cpu():
+    x = torch.tensor(np.random.RandomState(0).poisson(3, (6, 5)) + 1.0).float()
+    ones = torch.ones(6, 1)
+    batch_index = torch.zeros(6, 1, dtype=torch.long)
+    losses = []
+    for flags in [{}, dict(compile_enabled=True, autocast_enabled=True)]:
+        torch.manual_seed(0)
+        jvae = JVAE(
+            [5, 5], 5, [slice(None)] * 2, ["zinb"] * 2, [True] * 2, n_batch=1, **flags
+        )
+        jvae.eval()
+        torch.manual_seed(1)
+        losses.append(jvae(x, ones, ones, batch_index, mode=1))
+        assert jvae._compiled == {}
+    for eager, fallback in zip(*losses):
+        assert torch.equal(eager, fallback)
+
+
+def test_jvae_single_head_mode():
+    jvae = JVAE([5], 5, [slice(None)], ["nb"], [False], n_batch=1)
+    x = torch.tensor(np.random.RandomState(0).poisson(3, (4, 5)) + 1.0).float()
+    ones = torch.ones(4, 1)
+    batch_index = torch.zeros(4, 1, dtype=torch.long)
+    jvae(x, ones, ones, batch_index, mode=0)
+    with pytest.raises(Exception):
+        jvae(x, ones, ones, batch_index, mode=1)
+
+
+def test_jvae_freed_without_cycle_collector():
+    gc.collect()
+    gc.disable()
+    try:
+        for n_heads in [1, 2]:
+            jvae = JVAE(
+                [5] * n_heads,
+                5,
+                [slice(None)] * n_heads,
+                ["nb"] * n_heads,
+                [True] * n_heads,
+            )
+            ref = weakref.ref(jvae)
+            del jvae
+            assert ref() is None
+    finally:
+        gc.enable()
+
+
+def test_jvae_draws_noise_in_input_dtype():
+    jvae = JVAE([5], 5, [slice(None)], ["nb"], [True], dispersion="gene").double()
+    x = torch.tensor(np.random.RandomState(0).poisson(3, (4, 5)) + 1.0).double()
+    torch.manual_seed(0)
+    qz_m, qz_v, z, ql_m, ql_v, library, _ = jvae.encode(x, 0)
+    torch.manual_seed(0)
+    noise = torch.randn(4, jvae.n_latent + 1, dtype=torch.float64)
+    assert torch.equal(z, qz_m + qz_v.sqrt() * noise[:, :-1])
+    assert torch.equal(library, ql_m + ql_v.sqrt() * noise[:, -1:])
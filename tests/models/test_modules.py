@@ -0,0 +1,22 @@
+import pytest
+import torch
+
+from scvi.models.modules import Encoder, MultiEncoder
+
+
+def test_encoder_noise_requires_gaussian_latent():
+    x = torch.rand(4, 5)
+    noise = torch.randn(4, 3)
+    for model_type in ["gaussian", "laplace"]:
+        encoder = Encoder(5, 3, model_type=model_type)
+        multi_encoder = MultiEncoder(1, [5], 3, model_type=model_type)
+        if model_type == "gaussian":
+            q_m, q_v, latent = encoder(x, noise=noise)
+            assert torch.allclose(latent, q_m + q_v.sqrt() * noise)
+            q_m, q_v, latent = multi_encoder.forward_head(0, x, noise=noise)
+            assert torch.allclose(latent, q_m + q_v.sqrt() * noise)
+        else:
+            with pytest.raises(ValueError):
+                encoder(x, noise=noise)
+            with pytest.raises(ValueError):
+                multi_encoder.forward_head(0, x, noise=noise)